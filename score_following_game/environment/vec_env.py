@@ -0,0 +1,197 @@
+import ctypes
+import pickle
+
+import cloudpickle
+import multiprocessing as mp
+import numpy as np
+
+# ctypes used to back the shared observation buffers
+NP_TO_CT = {np.float32: ctypes.c_float,
+            np.float64: ctypes.c_double,
+            np.int32: ctypes.c_int32,
+            np.int8: ctypes.c_int8,
+            np.uint8: ctypes.c_char,
+            np.bool_: ctypes.c_bool}
+
+
+class CloudpickleWrapper(object):
+
+    def __init__(self, x):
+        """
+        Use cloudpickle to serialize the environment constructors (closures can not be pickled otherwise)
+        """
+        self.x = x
+
+    def __getstate__(self):
+        return cloudpickle.dumps(self.x)
+
+    def __setstate__(self, ob):
+        self.x = pickle.loads(ob)
+
+
+def _worker(remote, parent_remote, env_fn_wrapper, obs_bufs, obs_shapes, obs_dtypes):
+
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+
+    # numpy views on the shared memory of this worker
+    obs_views = dict()
+    for obs_key in obs_bufs:
+        obs_views[obs_key] = np.frombuffer(obs_bufs[obs_key], dtype=obs_dtypes[obs_key]).reshape(obs_shapes[obs_key])
+
+    def write_obs(observation):
+        for key in obs_views:
+            np.copyto(obs_views[key], observation[key])
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+
+            if cmd == 'step':
+                observation, reward, done, info = env.step(data)
+
+                # automatically start a new episode, the agent gets the first observation of the new episode
+                if done:
+                    observation = env.reset()
+
+                write_obs(observation)
+                remote.send((reward, done, info))
+
+            elif cmd == 'reset':
+                write_obs(env.reset())
+                remote.send(None)
+
+            elif cmd == 'close':
+                remote.close()
+                break
+
+            else:
+                raise NotImplementedError('Invalid command {}'.format(cmd))
+
+    except KeyboardInterrupt:
+        print('SubprocVecEnv worker: got KeyboardInterrupt')
+    finally:
+        env.close()
+
+
+class SubprocVecEnv(object):
+
+    def __init__(self, env_fns, context='spawn'):
+        """
+        Run multiple environments in parallel subprocesses and step them as a batch.
+        Observations are written to shared memory (one buffer per worker and observation key),
+        only actions, rewards and done flags are sent through the pipes.
+        """
+        ctx = mp.get_context(context)
+
+        dummy = env_fns[0]()
+        self.observation_space, self.action_space = dummy.observation_space, dummy.action_space
+        dummy.close()
+        del dummy
+
+        self.n_envs = len(env_fns)
+
+        self.obs_shapes = dict()
+        self.obs_dtypes = dict()
+        for obs_key, space in self.observation_space.spaces.items():
+            self.obs_shapes[obs_key] = tuple(int(x) for x in space.shape)
+            self.obs_dtypes[obs_key] = np.dtype(space.dtype)
+
+        self.obs_bufs = []
+        for _ in range(self.n_envs):
+            self.obs_bufs.append({obs_key: ctx.Array(NP_TO_CT[self.obs_dtypes[obs_key].type],
+                                                     int(np.prod(self.obs_shapes[obs_key])), lock=False)
+                                  for obs_key in self.obs_shapes})
+
+        # numpy views on the shared memory and contiguous float32 buffers holding the stacked observations
+        self.obs_views = []
+        for obs_buf in self.obs_bufs:
+            self.obs_views.append({obs_key: np.frombuffer(obs_buf[obs_key], dtype=self.obs_dtypes[obs_key])
+                                   .reshape(self.obs_shapes[obs_key]) for obs_key in self.obs_shapes})
+
+        self.stacked_obs = dict()
+        for obs_key in self.obs_shapes:
+            self.stacked_obs[obs_key] = np.empty((self.n_envs,) + self.obs_shapes[obs_key], dtype=np.float32)
+
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.n_envs)])
+
+        self.processes = []
+        for work_remote, remote, env_fn, obs_buf in zip(self.work_remotes, self.remotes, env_fns, self.obs_bufs):
+            args = (work_remote, remote, CloudpickleWrapper(env_fn), obs_buf, self.obs_shapes, self.obs_dtypes)
+            process = ctx.Process(target=_worker, args=args)
+            # if the main process crashes, we should not cause things to hang
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        for work_remote in self.work_remotes:
+            work_remote.close()
+
+        self.waiting = False
+        self.closed = False
+
+    def reset(self):
+
+        if self.waiting:
+            self.step_wait()
+
+        for remote in self.remotes:
+            remote.send(('reset', None))
+
+        for remote in self.remotes:
+            remote.recv()
+
+        return self._decode_obs()
+
+    def step_async(self, actions):
+
+        assert not self.waiting, 'step_async called while waiting for a previous step'
+
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+
+        self.waiting = True
+
+    def step_wait(self):
+
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+
+        rewards, dones, infos = zip(*results)
+
+        return self._decode_obs(), np.array(rewards), np.array(dones), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        if self.waiting:
+            self.step_wait()
+
+        for remote in self.remotes:
+            remote.send(('close', None))
+
+        for process in self.processes:
+            process.join()
+
+        self.closed = True
+
+    def _decode_obs(self):
+        """
+        Stack the observations of all workers into the float32 buffers.
+        The returned arrays are reused and only valid until the next call of reset or step
+        """
+        observation = dict()
+
+        for obs_key in self.obs_shapes:
+            for i, obs_view in enumerate(self.obs_views):
+                np.copyto(self.stacked_obs[obs_key][i], obs_view[obs_key])
+
+            observation[obs_key] = self.stacked_obs[obs_key]
+
+        return observation
@@ -6,12 +6,12 @@ import torch
 
 import numpy as np
 
-from baselines.common.vec_env.shmem_vec_env import ShmemVecEnv
 from score_following_game.agents.networks_utils import get_network
 from score_following_game.agents.optim_utils import get_optimizer, cast_optim_params
 from score_following_game.data_processing.data_pools import get_data_pools, get_shared_cache_pools
 from score_following_game.data_processing.data_production import create_song_producer, create_song_cache
 from score_following_game.data_processing.utils import load_game_config
+from score_following_game.environment.vec_env import SubprocVecEnv
 from score_following_game.evaluation.evaluation import PerformanceEvaluator as Evaluator
 from score_following_game.experiment_utils import setup_parser, setup_logger, setup_agent, make_env_tismir, get_make_env
 from score_following_game.reinforcement_learning.torch_extentions.optim.lr_scheduler import RefinementLRScheduler
@@ -66,7 +66,7 @@ if __name__ == '__main__':
     if args.agent == 'reinforce':
         env = get_make_env(rl_pools[0], config, env_fnc, render_mode=None)()
     else:
-        env = ShmemVecEnv([get_make_env(rl_pools[i], config, env_fnc, render_mode=None) for i in range(args.n_worker)])
+        env = SubprocVecEnv([get_make_env(rl_pools[i], config, env_fnc, render_mode=None) for i in range(args.n_worker)])
 
     # compile network architecture
     net = get_network('networks_sheet_spec', args.net, env.action_space.n,
@@ -81,7 +81,8 @@ if __name__ == '__main__':
 
     # initialize model
     model = Model(net, optimizer, max_grad_norm=args.max_grad_norm, value_coef=args.value_coef,
-                  entropy_coef=args.entropy_coef)
+                  entropy_coef=args.entropy_coef, use_amp=args.use_amp and args.use_cuda,
+                  compile_mode=args.compile_mode)
 
     # initialize refinement scheduler
     lr_scheduler = RefinementLRScheduler(optimizer=optimizer, model=model, n_refinement_steps=args.max_refinements,
@@ -112,7 +113,8 @@ if __name__ == '__main__':
         with open(os.path.join(args.log_dir, 'song_history.pkl'), 'wb') as f:
             pickle.dump(producer_process.cache.get_history(), f)
 
-    # stop the producer thread
+    # stop the environment workers and the producer thread
+    env.close()
     producer_process.terminate()
 
     if not args.no_log:
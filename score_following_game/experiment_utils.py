@@ -21,6 +21,10 @@ def setup_parser():
     parser.add_argument('--game_config', help='path to game config file.', type=str,
                         default='game_configs/midi_config.yaml')
     parser.add_argument('--use_cuda', help='if set use gpu instead of cpu.', action='store_true')
+    parser.add_argument('--use_amp', help='if set use mixed precision on the gpu (requires --use_cuda and torch.cuda.amp).',
+                        action='store_true')
+    parser.add_argument('--compile_mode', help='compile the network forward pass with this torch.compile mode.',
+                        choices=[None, 'default', 'reduce-overhead', 'max-autotune'], type=str, default=None)
     parser.add_argument('--seed', help='random seed.', type=np.int, default=4711)
 
     # agent parameters
@@ -5,6 +5,8 @@ import numpy as np
 
 from collections import OrderedDict
 from score_following_game.reinforcement_learning.algorithms.agent import Agent
+from score_following_game.reinforcement_learning.algorithms.utils import compute_gae_returns, compute_discounted_returns, \
+    update_reward_bookkeeping
 from score_following_game.reinforcement_learning.torch_extentions.distributions.adapted_categorical import AdaptedCategorical
 
 
@@ -27,36 +29,47 @@ class A2CAgent(Agent):
         for obs_key in self.observation_space:
 
             obs_shape = self.observation_space[obs_key].shape
-            self.observations[obs_key] = torch.zeros(self.t_max + 1, self.n_worker,
-                                                     *[int(x) for x in list(obs_shape)]).to(self.device)
+            self.observations[obs_key] = torch.zeros(self.t_max + 1, self.n_worker, *[int(x) for x in list(obs_shape)],
+                                                     device=self.device)
 
-        self.rewards = []
-        self.value_predictions = torch.zeros(self.t_max + 1, self.n_worker, 1).to(self.device)
-        self.returns = torch.zeros(self.t_max + 1, self.n_worker, 1).to(self.device)
+        self.rewards = torch.zeros(self.t_max, self.n_worker, 1, device=self.device)
+        self.value_predictions = torch.zeros(self.t_max + 1, self.n_worker, 1, device=self.device)
+        self.returns = torch.zeros(self.t_max + 1, self.n_worker, 1, device=self.device)
 
-        self.actions = self.action_tensor(self.t_max, self.n_worker, self.n_actions).to(self.device)
-        self.masks = torch.ones(self.t_max, self.n_worker, 1).to(self.device)
+        self.actions = torch.zeros(self.t_max, self.n_worker, self.n_actions, dtype=self.action_dtype, device=self.device)
+        self.masks = torch.ones(self.t_max, self.n_worker, 1, device=self.device)
 
         # we will only store the log probs of the chose actions
-        self.old_log_probs = torch.zeros(self.t_max, self.n_worker, 1).to(self.device)
+        self.old_log_probs = torch.zeros(self.t_max, self.n_worker, 1, device=self.device)
 
         # reward bookkeeping
-        self.episode_rewards = torch.zeros([self.n_worker, 1]).to(self.device)
-        self.final_rewards = torch.zeros([self.n_worker, 1]).to(self.device)
+        self.episode_rewards = torch.zeros([self.n_worker, 1], device=self.device)
+        self.final_rewards = torch.zeros([self.n_worker, 1], device=self.device)
+
+        # pinned host buffers to stage the env returns for asynchronous host to device copies
+        self.obs_staging = OrderedDict()
+        for obs_key in self.observations:
+            self.obs_staging[obs_key] = torch.empty(self.observations[obs_key].shape[1:], pin_memory=self.use_cuda)
+        self.reward_staging = torch.empty(self.n_worker, 1, pin_memory=self.use_cuda)
+        self.mask_staging = torch.empty(self.n_worker, 1, pin_memory=self.use_cuda)
+
+        # numpy views share the memory of the staging buffers
+        self.reward_staging_np = self.reward_staging.numpy()
+        self.mask_staging_np = self.mask_staging.numpy()
+
+        # done masks of the latest env step and broadcastable views of them for each observation
+        self.step_masks = torch.ones(self.n_worker, 1, device=self.device)
+        self.step_mask_views = OrderedDict()
+        for obs_key in self.observations:
+            self.step_mask_views[obs_key] = self.step_masks.view(self.n_worker,
+                                                                 *[1 for _ in self.observations[obs_key].shape[2:]])
 
         self.step = 0
+        self.pending_step = None
         self.first_obs = False
         self.gae = gae
         self.gae_lambda = gae_lambda
 
-    def on_done(self, state_tensor_list, np_masks):
-
-        # If done then clean the current observation
-        for key in state_tensor_list:
-            pt_masks = torch.from_numpy(np_masks.reshape(np_masks.shape[0], *[1 for _ in range(
-                len(state_tensor_list[key].shape[1:]))])).to(self.device)
-            state_tensor_list[key] *= pt_masks
-
     def prepare_model_input(self, step):
 
         model_in = OrderedDict()
@@ -79,41 +92,39 @@ class A2CAgent(Agent):
 
         if len(state) == 4:
             observation, reward, done, _ = state
-            reward = np.asarray([reward])
-            reward = torch.from_numpy(reward).transpose(1, 0).to(self.device)
-
-            self.episode_rewards += reward
-
-            self.rewards.append(reward)
 
-            np_masks = np.array([0.0 if done_ else 1.0 for done_ in done], dtype=np.float32)
+            # stage rewards and masks in pinned memory and copy them asynchronously to the device
+            self.reward_staging_np[:, 0] = reward
+            self.mask_staging_np[:, 0] = np.logical_not(done)
 
-            # create a list of state tensors and be sure that they are of type float
-            state_tensor_list = OrderedDict()
+            step_rewards = self.rewards[self.step - 1]
+            step_rewards.copy_(self.reward_staging, non_blocking=True)
+            self.step_masks.copy_(self.mask_staging, non_blocking=True)
 
+            # store observations, the vectorized env returns contiguous float32 arrays which are wrapped without a copy
             for obs_key in observation:
-                state_tensor_list[obs_key] = torch.from_numpy(observation[obs_key]).view(self.observations[obs_key]
-                                                                                         .shape[1:]).to(self.device)
+                obs = self.observations[obs_key][self.step]
+                env_obs = torch.as_tensor(observation[obs_key]).reshape(obs.shape)
 
-            self.on_done(state_tensor_list, np_masks)
+                # only stage the observations in pinned memory if they have to be transferred to the gpu
+                if self.use_cuda:
+                    env_obs = self.obs_staging[obs_key].copy_(env_obs)
 
-            # store observations
-            for obs_key in state_tensor_list:
-                self.observations[obs_key][self.step].copy_(state_tensor_list[obs_key])
+                obs.copy_(env_obs, non_blocking=True)
+
+                # if done then clean the current observation
+                obs.mul_(self.step_mask_views[obs_key])
 
             if train and self.step == self.t_max:
                 self.first_obs = False
                 self.perform_update()
                 self.step = 0
-                self.rewards = []
                 self.store_step_states()
 
-            self.masks[self.step].copy_(torch.from_numpy(np_masks).unsqueeze(1))
+            self.masks[self.step].copy_(self.step_masks)
 
             # bookkeeping of rewards
-            self.final_rewards *= self.masks[self.step]
-            self.final_rewards += (1 - self.masks[self.step]) * self.episode_rewards
-            self.episode_rewards *= self.masks[self.step]
+            update_reward_bookkeeping(self.episode_rewards, self.final_rewards, step_rewards, self.step_masks)
 
         else:
             observation = state
@@ -127,75 +138,75 @@ class A2CAgent(Agent):
         policy = model_returns['policy']
         value = model_returns['value']
 
-        action_tensor, np_actions = self.model.sample_action(policy)
+        # sample on the device and only transfer the actions required by the env to the host
+        action_tensor = self.model.sample_action_tensor(policy)
+        np_actions = action_tensor.cpu().numpy()
 
-        # primarily used for ppo
-        log_probs = self.model.get_log_probs(policy, action_tensor).data
+        # the rollout storage is filled in finish_step, while the env computes the next step
+        self.pending_step = (policy, value, action_tensor, train)
 
-        # self.actions[self.step].copy_(action_tensor.view(-1, 1))
+        return np_actions, False
+
+    def finish_step(self):
+
+        if self.pending_step is None:
+            return
 
-        if self.n_actions == 1 and action_tensor.dim() < 2:
-            # otherwise we get wrong dimension
-            # TODO find better solution
-            action_tensor = action_tensor.unsqueeze(-1)
+        policy, value, action_tensor, train = self.pending_step
+        self.pending_step = None
+
+        # primarily used for ppo
+        log_probs = self.model.get_log_probs(policy, action_tensor)
 
-        self.actions[self.step].copy_(action_tensor)
-        self.value_predictions[self.step].copy_(value.data)
+        self.actions[self.step].copy_(action_tensor.view_as(self.actions[self.step]))
+        self.value_predictions[self.step].copy_(value)
 
         self.old_log_probs[self.step].copy_(log_probs)
 
         if train:
             self.step += 1
 
-        return np_actions, False
-
     def prepare_single_forward_pass(self):
 
         model_in = OrderedDict()
 
         for obs_key in self.observations:
             obs = self.observations[obs_key]
-            model_in[obs_key] = obs[:-1].view(-1, *obs.size()[2:])
+            model_in[obs_key] = obs.view(-1, *obs.size()[2:])
 
         return model_in
 
     def perform_update(self):
         super().perform_update()
 
+        # a single forward pass over all observations including the latest ones (used for bootstrapping)
         model_returns = self.model(self.prepare_single_forward_pass())
 
-        policy = model_returns['policy']
-        values = model_returns['value']
+        n_samples = self.n_worker * self.t_max
+        policy = {key: model_returns['policy'][key][:n_samples] for key in model_returns['policy']}
+        values = model_returns['value'][:n_samples]
+        bootstrap_values = model_returns['value'][n_samples:].detach()
 
         if self.gae:
-            with torch.no_grad():
-                self.value_predictions[-1] = self.model.forward_value(self.prepare_model_input(-1))
+            self.value_predictions[-1] = bootstrap_values
 
-            gae = 0
-
-            for step in reversed(range(self.t_max)):
-                delta = self.rewards[step] + self.gamma * self.value_predictions[step + 1] * self.masks[step] \
-                        - self.value_predictions[step]
-                gae = delta + self.gamma * self.gae_lambda * self.masks[step] * gae
-                self.returns[step] = gae + self.value_predictions[step]
+            compute_gae_returns(self.returns, self.rewards, self.value_predictions, self.masks,
+                                self.gamma, self.gae_lambda)
 
         else:
             # calculate returns
-            with torch.no_grad():
-                self.returns[-1] = self.model.forward_value(self.prepare_model_input(-1))
+            self.returns[-1] = bootstrap_values
 
-            for step in reversed(range(self.t_max)):
-                self.returns[step] = self.returns[step + 1] * self.gamma * self.masks[step] + self.rewards[step]
+            compute_discounted_returns(self.returns, self.rewards, self.masks, self.gamma)
 
         advantages = self.returns[:-1].view(-1).unsqueeze(1) - values
 
-        log_probs = self.model.get_log_probs(policy, self.actions.view(self.n_worker * self.t_max, -1)).view(-1, 1)
-
-        dist_entropy = self.model.calc_entropy(policy)
+        log_probs, dist_entropy = self.model.evaluate_actions(policy, self.actions.view(self.n_worker * self.t_max, -1))
+        log_probs = log_probs.view(-1, 1)
 
         value_loss = advantages.pow(2).mean(dim=0)
 
-        policy_loss = -(advantages.data * log_probs).mean(dim=0)
+        policy_loss = -(advantages.detach() * log_probs).mean(dim=0)
 
         losses = dict(policy_loss=policy_loss, value_loss=value_loss,
                       dist_entropy=dist_entropy)
@@ -47,9 +47,11 @@ class Agent(object):
         self.step_cnt = 0
         self.now = self.after = None
         self.step_times = np.ones(11, dtype=np.float32) # 11 is just a random number to have a running avg
+        self.step_time_idx = 0
+        self.print_interval = max(1, self.log_interval // 10)
 
         self.distribution = distribution
-        self.action_tensor = torch.LongTensor if self.distribution == AdaptedCategorical else torch.FloatTensor
+        self.action_dtype = torch.long if self.distribution == AdaptedCategorical else torch.float
 
         self.buffer = buffer
 
@@ -61,6 +63,10 @@ class Agent(object):
         # return dummy values
         return None, None
 
+    def finish_step(self):
+        # bookkeeping of the selected action that can run while the environment computes the next step
+        pass
+
     def perform_update(self):
 
         # logging
@@ -78,13 +84,17 @@ class Agent(object):
 
         self.update_cnt += 1
 
-        # estimate updates per second (running avg)
-        self.step_times[0:-1] = self.step_times[1::]
-        self.step_times[-1] = time.time() - self.after
-        ups = 1.0 / self.step_times.mean()
-        self.after = time.time()
-        print("update %d @ %.1fups" % (np.mod(self.update_cnt, self.log_interval), ups), end="\r")
-        sys.stdout.flush()
+        # estimate updates per second (running avg over a circular buffer)
+        now = time.time()
+        self.step_times[self.step_time_idx] = now - self.after
+        self.step_time_idx = (self.step_time_idx + 1) % len(self.step_times)
+        self.after = now
+
+        # printing and flushing stdout at every update slows down training at high update rates
+        if self.update_cnt % self.print_interval == 0:
+            ups = len(self.step_times) / self.step_times.sum()
+            print("update %d @ %.1fups" % (self.update_cnt % self.log_interval, ups), end="\r")
+            sys.stdout.flush()
 
     def store_model(self, name, store_dir=None):
 
@@ -122,7 +132,7 @@ class Agent(object):
             for tag, value in self.model.net.named_parameters():
                 tag = tag.replace('.', '/')
                 if value.grad is not None:
-                    self.log_writer.add_histogram(tag + '/grad', value.grad.data.cpu().norm(2).item(),  int(self.update_cnt / self.log_interval))
+                    self.log_writer.add_histogram(tag + '/grad', value.grad.norm(2).item(),  int(self.update_cnt / self.log_interval))
 
         print('-' * 32)
         self.now = time.time()
@@ -152,11 +162,21 @@ class Agent(object):
         state = env.reset()
         step_cnt = 0
 
+        # vectorized environments are stepped asynchronously to overlap them with the agent's bookkeeping
+        async_env = hasattr(env, 'step_async')
+
         while step_cnt < max_steps:
             action, done = self.select_action(state)
 
+            if async_env and not done:
+                env.step_async(action)
+
+            self.finish_step()
+
             if done:
                 state = env.reset()
+            elif async_env:
+                state = env.step_wait()
             else:
                 state = env.step(action)
 
@@ -205,7 +225,7 @@ class TrainedAgent(Agent):
 
         value = self.model(self.prepare_state(state))['value']
 
-        return value.data.cpu().numpy()[0, 0]
+        return value.detach().cpu().numpy()[0, 0]
 
 
 def get_agent(agent, **params):
@@ -1,16 +1,25 @@
 import torch
 
 import torch.nn as nn
+import torch.nn.functional as F
 
 from score_following_game.reinforcement_learning.torch_extentions.distributions.adapted_categorical import AdaptedCategorical
 
 
+def cast_to_float(model_returns):
+    # recursively cast the (nested dict of) network returns to full precision
+    if isinstance(model_returns, dict):
+        return {key: cast_to_float(model_returns[key]) for key in model_returns}
+
+    return model_returns.float()
+
+
 class Model(nn.Module):
     """
     Template for creating models used in the reinforcement learning algorithms
     """
     def __init__(self, net, optimizer, max_grad_norm=0.5, value_coef=0.5,
-                 entropy_coef=0.01, distribution=AdaptedCategorical):
+                 entropy_coef=0.01, distribution=AdaptedCategorical, use_amp=False, compile_mode=None):
         super(Model, self).__init__()
 
         self.net = net
@@ -20,26 +29,70 @@ class Model(nn.Module):
         self.entropy_coef = entropy_coef
         self.distribution = distribution
 
+        # mixed precision forward passes with loss scaling (master weights stay in full precision)
+        self.use_amp = use_amp
+        self.grad_scaler = None
+
+        if self.use_amp:
+            if not hasattr(torch.cuda, 'amp'):
+                raise RuntimeError('Mixed precision training requires torch.cuda.amp (PyTorch >= 1.6)')
+
+            # autocast has no effect on cpu tensors and the grad scaler only supports cuda tensors
+            if not torch.cuda.is_available():
+                raise ValueError('Mixed precision training requires cuda')
+
+            self.grad_scaler = torch.cuda.amp.GradScaler()
+
+        # optionally compile the forward pass of the network, parameters and state dict stay those of self.net
+        self.net_forward = self.net.forward
+
+        if compile_mode is not None:
+            if not hasattr(torch, 'compile'):
+                raise RuntimeError('Compiling the network requires torch.compile (PyTorch >= 2.0)')
+
+            self.net_forward = torch.compile(self.net.forward, mode=compile_mode, dynamic=False)
+
     def forward(self, x):
-        return self.net.forward(**x)
+
+        if not self.use_amp:
+            return self.net_forward(**x)
+
+        with torch.cuda.amp.autocast():
+            model_returns = self.net_forward(**x)
+
+        # distributions and losses are computed in full precision
+        return cast_to_float(model_returns)
 
     def forward_policy(self, x):
-        return self.net.forward(**x)['policy']
+        return self.forward(x)['policy']
 
     def forward_value(self, x):
-        return self.net.forward(**x)['value']
+        return self.forward(x)['value']
 
     def update(self, losses):
 
         self.optimizer.zero_grad()
-        (losses['policy_loss'] +
-         self.value_coef * losses['value_loss'] -
-         self.entropy_coef * losses['dist_entropy']).backward()
+        loss = losses['policy_loss'] + self.value_coef * losses['value_loss'] - \
+            self.entropy_coef * losses['dist_entropy']
+
+        if self.grad_scaler is None:
+            loss.backward()
 
-        if self.max_grad_norm is not None:
-            torch.nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
+            if self.max_grad_norm is not None:
+                torch.nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
 
-        self.optimizer.step()
+            self.optimizer.step()
+
+        else:
+            self.grad_scaler.scale(loss).backward()
+
+            if self.max_grad_norm is not None:
+                # gradients have to be unscaled before clipping
+                self.grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.net.parameters(), self.max_grad_norm)
+
+            self.grad_scaler.step(self.optimizer)
+            self.grad_scaler.update()
 
     def set_train_mode(self):
         self.net.train()
@@ -61,19 +114,33 @@ class Model(nn.Module):
         return self.distribution(**policy).entropy().sum(-1).mean(dim=0, keepdim=True)
 
     def get_log_probs(self, policy, actions):
+
+        if self.distribution == AdaptedCategorical and 'logits' in policy:
+            # fused log softmax and gather of the chosen actions
+            return -F.cross_entropy(policy['logits'], actions.view(-1), reduction='none').unsqueeze(-1)
+
         return self.distribution(**policy).log_prob(actions).sum(-1, keepdim=True)
 
-    def sample_action(self, policy, deterministic=False):
+    def evaluate_actions(self, policy, actions):
+        # log probs and entropy share one distribution, so the (log) softmax of the policy is computed only once
+        distr = self.distribution(**policy)
+        return distr.log_prob(actions).sum(-1, keepdim=True), distr.entropy().sum(-1).mean(dim=0, keepdim=True)
+
+    def sample_action_tensor(self, policy, deterministic=False):
 
         distr = self.distribution(**policy)
 
         if deterministic:
             # in case of discrete actions the mean will be the argmax decision
-            actions = distr.mean
-        else:
-            actions = distr.sample()
+            return distr.mean
+
+        return distr.sample()
+
+    def sample_action(self, policy, deterministic=False):
+
+        actions = self.sample_action_tensor(policy, deterministic=deterministic)
 
-        return actions, actions.cpu().detach().numpy()
+        return actions, actions.cpu().numpy()
 
 
 
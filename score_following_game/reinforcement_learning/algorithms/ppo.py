@@ -3,8 +3,8 @@ import torch
 from collections import OrderedDict
 from score_following_game.reinforcement_learning.algorithms.a2c import A2CAgent
 from score_following_game.reinforcement_learning.algorithms.agent import Agent
+from score_following_game.reinforcement_learning.algorithms.utils import compute_gae_returns, compute_ppo_policy_loss
 from score_following_game.reinforcement_learning.torch_extentions.distributions.adapted_categorical import AdaptedCategorical
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 
 
 class PPOAgent(A2CAgent):
@@ -25,6 +25,12 @@ class PPOAgent(A2CAgent):
         self.batch_size = batch_size
         self.clip_value = clip_value
 
+        # preallocated mini batch buffers for the observations
+        self.batch_observations = OrderedDict()
+        for obs_key in self.observations:
+            obs_shape = self.observations[obs_key].shape[2:]
+            self.batch_observations[obs_key] = torch.zeros(self.batch_size, *obs_shape, device=self.device)
+
         self.alpha = 1
 
     def perform_update(self):
@@ -33,17 +39,11 @@ class PPOAgent(A2CAgent):
         with torch.no_grad():
             self.value_predictions[-1] = self.model.forward_value(self.prepare_model_input(-1))
 
-        gae = 0
-
-        for step in reversed(range(self.t_max)):
-            delta = self.rewards[step] + self.gamma * self.value_predictions[step + 1] * self.masks[step] \
-                    - self.value_predictions[step]
-            gae = delta + self.gamma * self.gae_lambda * self.masks[step] * gae
-            self.returns[step] = gae + self.value_predictions[step]
+        compute_gae_returns(self.returns, self.rewards, self.value_predictions, self.masks, self.gamma, self.gae_lambda)
 
         advantages = self.returns[:-1] - self.value_predictions[:-1]
 
-        advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-5)
+        advantages = (advantages - advantages.mean()) / (advantages.std(unbiased=False) + 1e-5)
 
         value_loss_epoch = 0
         policy_loss_epoch = 0
@@ -51,39 +51,50 @@ class PPOAgent(A2CAgent):
         explained_variance_epoch = 0
 
         n_updates = 0
+        n_samples = self.n_worker * self.t_max
 
         clip = self.epsilon * self.alpha
 
+        # flatten the rollout observations once per update (views on the contiguous rollout storage)
+        observations = OrderedDict()
+        for obs_key in self.observations:
+            obs = self.observations[obs_key]
+            observations[obs_key] = obs[:-1].view(-1, *obs.size()[2:])
+
+        # flat views of the remaining rollout storage, also created once per update
+        actions = self.actions.view(n_samples, -1)
+        returns = self.returns[:-1].view(-1, 1)
+        old_log_probs = self.old_log_probs.view(-1, *self.old_log_probs.size()[2:])
+        value_predictions = self.value_predictions[:-1].view(-1, 1)
+        advantages = advantages.view(-1, 1)
+
         for _ in range(self.ppo_epoch):
-            sampler = BatchSampler(SubsetRandomSampler(list(range(self.n_worker * self.t_max))),
-                                   self.batch_size, drop_last=False)
+            # random mini batches as slices of a single permutation kept on the device
+            permutation = torch.randperm(n_samples, device=self.device)
+
+            for start in range(0, n_samples, self.batch_size):
+                indices = permutation[start:start + self.batch_size]
 
-            for indices in sampler:
-                actions_batch = self.actions.view(self.n_worker * self.t_max, -1)[indices]
-                return_batch = self.returns[:-1].view(-1, 1)[indices]
-                old_log_probs_batch = self.old_log_probs.view(-1, *self.old_log_probs.size()[2:])[indices]
+                actions_batch = actions.index_select(0, indices)
+                return_batch = returns.index_select(0, indices)
+                old_log_probs_batch = old_log_probs.index_select(0, indices)
 
-                model_returns = self.model(self.prepare_batch_input(indices))
+                model_returns = self.model(self.prepare_batch_input(observations, indices))
 
                 policy = model_returns['policy']
                 values = model_returns['value']
 
-                action_log_probabilities = self.model.get_log_probs(policy, actions_batch)
-
-                ratio = torch.exp(action_log_probabilities - old_log_probs_batch)
+                action_log_probabilities, dist_entropy = self.model.evaluate_actions(policy, actions_batch)
 
-                advantage_target = advantages.view(-1, 1)[indices]
+                advantage_target = advantages.index_select(0, indices)
 
-                surr1 = ratio * advantage_target
-                surr2 = ratio.clamp(1.0 - clip, 1.0 + clip) * advantage_target
-
-                policy_loss = -torch.min(surr1, surr2).mean(dim=0)
-                dist_entropy = self.model.calc_entropy(policy)
+                policy_loss = compute_ppo_policy_loss(action_log_probabilities, old_log_probs_batch,
+                                                      advantage_target, clip)
 
                 # clip value loss according to
                 # https://github.com/openai/baselines/tree/master/baselines/ppo2
                 if self.clip_value:
-                    value_preds_batch = self.value_predictions[:-1].view(-1, 1)[indices]
+                    value_preds_batch = value_predictions.index_select(0, indices)
                     value_pred_clipped = value_preds_batch + \
                                          (values - value_preds_batch).clamp(-clip, clip)
                     value_losses = (return_batch - values).pow(2)
@@ -97,11 +108,12 @@ class PPOAgent(A2CAgent):
 
                 self.model.update(losses)
 
-                value_loss_epoch += value_loss.item()
-                policy_loss_epoch += policy_loss.item()
-                dist_entropy_epoch += dist_entropy.item()
+                # accumulate statistics on the device, they are only transferred to the host when logged
+                value_loss_epoch += value_loss.detach()
+                policy_loss_epoch += policy_loss.detach()
+                dist_entropy_epoch += dist_entropy.detach()
                 explained_variance_epoch += ((1 - (return_batch-values.detach()).var())
-                                             / return_batch.var()).item()
+                                             / return_batch.var())
                 n_updates += 1
 
         value_loss_epoch /= n_updates
@@ -120,12 +132,13 @@ class PPOAgent(A2CAgent):
             'ppo_epsilon': clip
         }
 
-    def prepare_batch_input(self, indices):
+    def prepare_batch_input(self, observations, indices):
 
         states_batch = OrderedDict()
 
-        for obs_key in self.observations:
-            obs = self.observations[obs_key]
-            states_batch[obs_key] = obs[:-1].view(-1, *obs.size()[2:])[indices]
+        for obs_key in observations:
+            # the last mini batch of an epoch might be smaller than the buffer
+            batch_buffer = self.batch_observations[obs_key][:indices.size(0)]
+            states_batch[obs_key] = torch.index_select(observations[obs_key], 0, indices, out=batch_buffer)
 
         return states_batch
@@ -21,7 +21,6 @@ class ReinforceAgent(Agent):
                        dump_interval=dump_interval, dump_dir=dump_dir)
 
         self.no_baseline = no_baseline
-        self.action_dtype = np.long
         self.max_steps = max_steps
 
         self.observations = OrderedDict()
@@ -112,7 +111,7 @@ class ReinforceAgent(Agent):
         for indices in sampler:
 
             Gt = torch.from_numpy(Gts[indices]).to(self.device)
-            At = self.action_tensor(self.actions[indices]).to(self.device)
+            At = torch.as_tensor(self.actions[indices], dtype=self.action_dtype, device=self.device)
 
             St = OrderedDict()
 
@@ -130,7 +129,7 @@ class ReinforceAgent(Agent):
 
             delta = Gt - baseline
 
-            eligibility = self.model.get_log_probs(policy, At) * delta.data
+            eligibility = self.model.get_log_probs(policy, At) * delta.detach()
 
             policy_loss = -eligibility.mean(dim=0)
             bl_loss = (delta ** 2).mean(dim=0)
@@ -0,0 +1,65 @@
+import torch
+
+
+@torch.jit.script
+def compute_gae_returns(returns, rewards, value_predictions, masks, gamma: float, gae_lambda: float):
+    """
+    Compute returns based on generalized advantage estimation (in place).
+    value_predictions and returns have one more time step than rewards and masks (bootstrap value).
+    Instead of the reverse recurrence the advantages are computed in closed form as a single batched matmul
+    with the decay matrix D[t, k] = prod_{t <= j < k} gamma * gae_lambda * masks[j]
+    """
+    t_max = rewards.size(0)
+
+    deltas = rewards + gamma * value_predictions[1:] * masks - value_predictions[:-1]
+
+    # factors[w, t, j] = gamma * gae_lambda * masks[j] for j >= t and 1 otherwise
+    upper = torch.ones(t_max, t_max, dtype=rewards.dtype, device=rewards.device).triu()
+    factors = (gamma * gae_lambda * masks).squeeze(-1).t().unsqueeze(1)
+    factors = factors * upper + (1 - upper)
+
+    # shift the cumulative products by one step, the factor of step k itself is not part of D[t, k]
+    decay = torch.cumprod(factors, dim=2)
+    decay = torch.cat([torch.ones_like(decay[:, :, :1]), decay[:, :, :-1]], dim=2) * upper
+
+    advantages = torch.matmul(decay, deltas.transpose(0, 1)).transpose(0, 1)
+
+    returns[:t_max] = advantages + value_predictions[:-1]
+    returns[t_max] = value_predictions[t_max]
+
+    return returns
+
+
+@torch.jit.script
+def compute_discounted_returns(returns, rewards, masks, gamma: float):
+    """
+    Compute discounted returns (in place), returns[-1] has to hold the bootstrap value
+    """
+    for step in range(rewards.size(0) - 1, -1, -1):
+        returns[step] = returns[step + 1] * gamma * masks[step] + rewards[step]
+
+    return returns
+
+
+@torch.jit.script
+def update_reward_bookkeeping(episode_rewards, final_rewards, rewards, masks):
+    """
+    Accumulate the rewards of the running episodes (in place).
+    For finished episodes (mask 0) the accumulated reward is moved to final_rewards
+    """
+    episode_rewards.add_(rewards)
+    final_rewards.mul_(masks).add_((1 - masks) * episode_rewards)
+    episode_rewards.mul_(masks)
+
+
+@torch.jit.script
+def compute_ppo_policy_loss(log_probs, old_log_probs, advantages, clip: float):
+    """
+    Clipped surrogate objective of PPO, scripted so that the element-wise ops can be fused
+    """
+    ratio = torch.exp(log_probs - old_log_probs)
+
+    surr1 = ratio * advantages
+    surr2 = ratio.clamp(1.0 - clip, 1.0 + clip) * advantages
+
+    return -torch.min(surr1, surr2).mean(dim=0)